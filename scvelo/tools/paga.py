@@ -6,27 +6,32 @@ from .velocity_graph import vals_to_csr
 from .velocity_pseudotime import velocity_pseudotime
 from .rank_velocity_genes import velocity_clusters
 import numpy as np
-import pandas as pd
 from scipy.sparse import csr_matrix
-from pandas.api.types import is_categorical
+from scipy.sparse.csgraph import minimum_spanning_tree
 from scanpy.tools._paga import PAGA
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, range
+
 
 def get_igraph_from_adjacency(adjacency, directed=None):
     """Get igraph graph from adjacency matrix."""
     import igraph as ig
 
-    sources, targets = adjacency.nonzero()
-    weights = adjacency[sources, targets]
-    if isinstance(weights, np.matrix):
-        weights = weights.A1
-    g = ig.Graph(directed=directed)
-    g.add_vertices(adjacency.shape[0])  # this adds adjacency.shap[0] vertices
-    g.add_edges(list(zip(sources, targets)))
-    try:
-        g.es["weight"] = weights
-    except:
-        pass
+    adjacency = csr_matrix(adjacency)
+    sources = np.repeat(np.arange(adjacency.shape[0]), np.diff(adjacency.indptr))
+    targets, weights = adjacency.indices, adjacency.data
+    if not np.all(weights):  # skip explicitly stored zeros
+        idx = weights != 0
+        sources, targets, weights = sources[idx], targets[idx], weights[idx]
+    g = ig.Graph(
+        n=adjacency.shape[0],
+        edges=np.column_stack((sources, targets)).tolist(),
+        directed=directed,
+        edge_attrs={"weight": weights.tolist()},
+    )
     if g.vcount() != adjacency.shape[0]:
         logg.warn(
             f"The constructed graph has only {g.vcount()} nodes. "
@@ -35,29 +40,56 @@ def get_igraph_from_adjacency(adjacency, directed=None):
     return g
 
 
-def get_sparse_from_igraph(graph, weight_attr=None):
-    edges = graph.get_edgelist()
-    if weight_attr is None:
-        weights = [1] * len(edges)
-    else:
-        weights = graph.es[weight_attr]
-    if not graph.is_directed():
-        edges.extend([(v, u) for u, v in edges])
-        weights.extend(weights)
-    shape = graph.vcount()
-    shape = (shape, shape)
-    if len(edges) > 0:
-        return csr_matrix((weights, zip(*edges)), shape=shape)
-    else:
-        return csr_matrix(shape)
+def _indirect_path_mask(T):
+    """Mark T[i, j] if min(T[i, k], T[k, j]) > T[i, j] for some k."""
+    n = T.shape[0]
+    mask = np.zeros((n, n), dtype=np.bool_)
+    for i in prange(n):
+        for j in range(n):
+            if T[i, j] > 0:
+                for k in range(n):
+                    if min(T[i, k], T[k, j]) > T[i, j]:
+                        mask[i, j] = True
+                        break
+    return mask
 
 
-def set_row_csr(csr, rows, value=0):
-    """Set all nonzero elements to the given value. Useful to set to 0 mostly."""
-    for row in rows:
-        csr.data[csr.indptr[row] : csr.indptr[row + 1]] = value
-    if value == 0:
-        csr.eliminate_zeros()
+if njit is not None:
+    _indirect_path_mask = njit(parallel=True, fastmath=True, cache=True)(
+        _indirect_path_mask
+    )
+
+
+def prune_indirect_paths(T, max_block_elements=2 ** 20):
+    """Remove direct paths for which a more confident indirect path exists.
+
+    The confidence of the indirect path i -> k -> j is min(T[i, k], T[k, j]), thus
+    the strongest indirect paths are given by the max-min product of T with itself.
+    If numba is available, this is evaluated by a compiled parallel kernel, otherwise
+    in blocks of rows to bound the memory of the (n, n, n) tensor.
+    """
+    if njit is not None:
+        T[_indirect_path_mask(np.ascontiguousarray(T))] = 0
+        return T
+
+    n = len(T)
+    block_size = max(1, max_block_elements // max(n * n, 1))
+    indirect = np.empty_like(T)
+    scratch = np.empty((min(block_size, n), n, n), dtype=T.dtype)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = np.minimum(T[start:stop, :, None], T[None], out=scratch[: stop - start])
+        block.max(1, out=indirect[start:stop])
+    T[T < indirect] = 0
+    return T
+
+
+def get_confidence_threshold(T, min_threshold=0.01):
+    """Get the minimum over groups of their most confident incoming transition."""
+    col_max = T.max(0, initial=0)
+    col_max = col_max[col_max > 0]
+    threshold = col_max.min() if len(col_max) > 0 else np.nan
+    return max(float(threshold) - 1e-6, min_threshold)
 
 
 class PAGA_tree(PAGA):
@@ -83,13 +115,14 @@ class PAGA_tree(PAGA):
             self.threshold_root_end_prior = 0.9
         self.minimum_spanning_tree = minimum_spanning_tree
 
+        # partition matrix assigning each cell to its group
+        clusters = adata.obs[groups]
+        membership = clusters.cat.codes.values.astype(np.int32, copy=False)
+        n_obs, n_groups = len(membership), len(clusters.cat.categories)
+        ones = np.ones(n_obs, dtype=np.float32)
+        self._P = csr_matrix((ones, (np.arange(n_obs), membership)), (n_obs, n_groups))
+
     def compute_transitions(self):
-        try:
-            import igraph
-        except ImportError:
-            raise ImportError(
-                "To run paga, you need to install `pip install python-igraph`"
-            )
         vkey = f"{self.vkey}_graph"
         if vkey not in self._adata.uns:
             raise ValueError(
@@ -104,13 +137,28 @@ class PAGA_tree(PAGA):
 
         clusters = self._adata.obs[self.groups]
         cats = clusters.cat.categories
-        vgraph = self._adata.uns[vkey] > 0.1
+        membership = clusters.cat.codes.values.astype(np.int32, copy=False)
         time_prior = self.use_time_prior
 
+        # threshold the velocity graph and remove transitions out of end states and
+        # into root states by masking the sparse entries in a single pass.
+        graph = csr_matrix(self._adata.uns[vkey])
+        keep = graph.data > 0.1
+        lb = self.threshold_root_end_prior  # cells to be consider as terminal states
+        if isinstance(self.end_key, str) and self.end_key in self._adata.obs.keys():
+            is_end = self._adata.obs[self.end_key].values > lb
+            keep &= ~np.repeat(is_end, np.diff(graph.indptr))
+        if isinstance(self.root_key, str) and self.root_key in self._adata.obs.keys():
+            is_root = self._adata.obs[self.root_key].values > lb
+            keep &= ~is_root[graph.indices]
+        indptr = np.append(0, np.cumsum(keep))[graph.indptr]
+        vals = np.ones(indptr[-1], dtype=np.float32)
+        vgraph = csr_matrix((vals, graph.indices[keep], indptr), graph.shape)
+
         if isinstance(time_prior, str) and time_prior in self._adata.obs.keys():
             vpt = self._adata.obs[time_prior].values
             vpt_mean = self._adata.obs.groupby(self.groups)[time_prior].mean()
-            vpt_means = np.array([vpt_mean[cat] for cat in clusters])
+            vpt_means = vpt_mean[cats].values[membership]
             rows, cols, vals = [], [], []
             for i in range(vgraph.shape[0]):
                 indices = vgraph[i].indices
@@ -121,58 +169,48 @@ class PAGA_tree(PAGA):
                 rows.extend([i] * np.sum(idx_bool))
             vgraph = vals_to_csr(vals, rows, cols, shape=vgraph.shape)
 
-        lb = self.threshold_root_end_prior  # cells to be consider as terminal states
-        if isinstance(self.end_key, str) and self.end_key in self._adata.obs.keys():
-            set_row_csr(vgraph, rows=np.where(self._adata.obs[self.end_key] > lb)[0])
-        if isinstance(self.root_key, str) and self.root_key in self._adata.obs.keys():
-            vgraph[:, np.where(self._adata.obs[self.root_key] > lb)[0]] = 0
-            vgraph.eliminate_zeros()
-
-        membership = self._adata.obs[self.groups].cat.codes.values
-        g = get_igraph_from_adjacency(vgraph, directed=True)
-        vc = igraph.VertexClustering(g, membership=membership)
-        cg_full = vc.cluster_graph(combine_edges="sum")
-        transitions = get_sparse_from_igraph(cg_full, weight_attr="weight")
-        transitions = transitions - transitions.T
-        transitions_conf = transitions.copy()
-        transitions = transitions.tocoo()
-        total_n = self._neighbors.n_neighbors * np.array(vc.sizes())
-        for i, j, v in zip(transitions.row, transitions.col, transitions.data):
-            reference = np.sqrt(total_n[i] * total_n[j])
-            transitions_conf[i, j] = 0 if v < 0 else v / reference
-        transitions_conf.eliminate_zeros()
+        # sum up edges between groups by contracting with the partition matrix
+        P = self._P
+        transitions = P.T.dot(vgraph.astype(np.float32, copy=False)).dot(P)
+        transitions = (transitions - transitions.T).tocoo()
+        sizes = np.bincount(membership, minlength=len(cats))
+        total_n = self._neighbors.n_neighbors * sizes
+        # only positive net transitions are confident, thus skip all other entries
+        # up front instead of zeroing and eliminating them afterwards.
+        rows, cols, vals = transitions.row, transitions.col, transitions.data
+        idx = vals > 0
+        rows, cols, vals = rows[idx], cols[idx], vals[idx]
+        vals /= np.sqrt(total_n[rows] * total_n[cols], dtype=np.float32)
+        transitions_conf = csr_matrix((vals, (rows, cols)), shape=transitions.shape)
+
+        # groups without any transitions cannot be part of a path, thus restrict the
+        # pruning below to the active groups and map back to all groups afterwards.
+        n_groups = transitions_conf.shape[0]
+        active = np.flatnonzero(transitions_conf.getnnz(0) + transitions_conf.getnnz(1))
 
         # remove non-confident direct paths if more confident indirect path is found.
-        T = transitions_conf.A
-        threshold = max(np.nanmin(np.nanmax(T / (T > 0), axis=0)) - 1e-6, 0.01)
-        T *= T > threshold
-        for i in range(len(T)):
-            idx = T[i] > 0
-            if np.any(idx):
-                indirect = np.clip(T[idx], None, T[i][idx][:, None]).max(0)
-                T[i, T[i] < indirect] = 0
-
-        if self.minimum_spanning_tree:
+        T = transitions_conf[active][:, active].A
+        T *= T > get_confidence_threshold(T)
+        T = prune_indirect_paths(T)
+
+        if self.minimum_spanning_tree and len(active) > 0:
             T_tmp = T.copy()
             T_num = T > 0
-            T_sum = np.sum(T_num, 0)
-            T_max = np.max(T_tmp)
-            for i in range(len(T_tmp)):
-                if T_sum[i] == 1:
-                    T_tmp[np.where(T_num[:, i])[0][0], i] = T_max
-            from scipy.sparse.csgraph import minimum_spanning_tree
+            # keep the only incoming edge of a group within the spanning tree
+            cols = np.flatnonzero(T_num.sum(0) == 1)
+            T_tmp[T_num[:, cols].argmax(0), cols] = T.max()
+            T *= minimum_spanning_tree(-T_tmp).A != 0
 
-            T_tmp = np.abs(minimum_spanning_tree(-T_tmp).A) > 0
-            T = T_tmp * T
+        # set threshold for minimal spanning tree.
+        self.threshold = get_confidence_threshold(T)
+        logg.msg(f"confidence threshold of transitions: {self.threshold}", v=4)
 
-        transitions_conf = csr_matrix(T)
+        T = csr_matrix(T).tocoo()
+        rows, cols = active[T.row], active[T.col]
+        shape = (n_groups, n_groups)
+        transitions_conf = csr_matrix((T.data, (rows, cols)), shape, dtype=np.float64)
         self.transitions_confidence = transitions_conf.T
 
-        # set threshold for minimal spanning tree.
-        df = pd.DataFrame(T, index=cats, columns=cats)
-        self.threshold = np.nanmin(np.nanmax(df.values / (df.values > 0), axis=0))
-        self.threshold = max(self.threshold - 1e-6, 0.01)
-
 
 def paga(
     adata,